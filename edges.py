@@ -9,8 +9,33 @@ from gerrychain import Graph
 import pandas as pd
 import geopandas as gpd
 import networkx as nx
+import numpy as np
+import shapely
+from scipy.sparse.csgraph import connected_components
 import matplotlib.pyplot as plt
-from shapely.geometry import  LineString
+
+# engine used by the edges_to_shapefile* writers, pyogrio writes features in bulk
+_WRITE_ENGINE = "pyogrio"
+
+##########
+# _component_labels()
+#  labels each node of a graph with its connected component, using scipy's
+#   csgraph routine on the adjacency matrix instead of a networkx BFS
+#
+# graph: the dual graph
+# key:   the unique identifier for each shape in the shapefile
+#
+# returns
+#  (keys, labels, sizes), where keys and labels are aligned with graph.nodes,
+#  keys is an object array of each node's `key` value, labels its component number,
+#  and sizes the number of nodes in each component
+def _component_labels(graph, key = "GEOID10"):
+    nodes = list(graph.nodes)
+    adj = nx.to_scipy_sparse_array(graph, nodelist = nodes, weight = None)
+    _n_comps, labels = connected_components(adj, directed = False)
+    sizes = np.bincount(labels)
+    keys = np.array([graph.nodes[n][key] for n in nodes], dtype = object)
+    return (keys, labels, sizes)
 
 ##########
 # plot_problems()
@@ -23,15 +48,14 @@ from shapely.geometry import  LineString
 #
 # returns
 #  a list of the shapes that are not in the largest component
+#  if components tie for largest, the first one in graph node order is kept as the largest
 #
 # adapted from GerryChain docs: https://gerrychain.readthedocs.io/en/latest/
 def plot_problems(graph, shp, key = "GEOID10"):
-    components = list(nx.connected_components(graph))
-    print([len(c) for c in components])
-    biggest_component_size = max(len(c) for c in components)
-    problem_components = [c for c in components if len(c) != biggest_component_size]
-    problem_nodes = [node for component in problem_components for node in component]
-    problem_geoids = [graph.nodes[node][key] for node in problem_nodes]
+    keys, labels, sizes = _component_labels(graph, key = key)
+    print(sizes.tolist())
+    biggest = sizes.argmax()
+    problem_geoids = keys[labels != biggest].tolist()
 
     is_a_problem = shp[key].isin(problem_geoids)
     shp.plot(column=is_a_problem, figsize=(10, 10))
@@ -51,25 +75,44 @@ def plot_problems(graph, shp, key = "GEOID10"):
 # returns
 #  nothing
 def plot_components(graph, shp, key = "GEOID10"):
-    components = list(nx.connected_components(graph))
-    print([len(c) for c in components])
-    keys_comps = [[graph.nodes[n][key] for n in c] for c in components]
-    
-    component_nums = []
-    for k in list(shp[key]):
-        for c in range(len(keys_comps)):
-            if k in keys_comps[c]:
-                component_nums += [c]
-                break
+    keys, labels, sizes = _component_labels(graph, key = key)
+    print(sizes.tolist())
+    # one hash lookup per shape, shapes whose key isn't in the graph map to NaN and are left unplotted
+    node_to_comp = dict(zip(keys, labels))
+    component_nums = shp[key].map(node_to_comp).to_numpy()
     
-    shp.plot(column=pd.Series(component_nums), figsize=(10, 10), cmap = 'tab10')
+    shp.plot(column=component_nums, figsize=(10, 10), cmap = 'tab10')
     plt.axis('off')
     plt.show()
 
 
+########
+# _get_key_index()
+#  builds (or reuses) a dict of key value -> node for a graph
+#  the index is cached on the graph per key, and rebuilt when the node count changes
+#  nodes without a `key` attribute are left out of the index
+#
+# graph:   the graph to index
+# key:     column/attribute to index nodes by
+# rebuild: if True, always rebuild the cached index
+#
+# returns
+#  dict of key value -> node, the first node in graph order wins if key values repeat
+def _get_key_index(graph, key = "GEOID10", rebuild = False):
+    indices = graph.__dict__.setdefault('_key_index', {})
+    n_nodes, idx = indices.get(key, (None, None))
+    if rebuild or idx is None or n_nodes != graph.number_of_nodes():
+        idx = {}
+        for n, attrs in graph.nodes(data = True):
+            if key in attrs:
+                idx.setdefault(attrs[key], n)
+        indices[key] = (graph.number_of_nodes(), idx)
+    return idx
+
 ########
 # find_node_by_key()
 #  finds a node in a graph by a column value
+#  deprecated, kept for compatibility, use the `*_by_feature` functions to edit graphs by key
 #
 # keyval: the lookup target value
 # graph:  the graph in which to search
@@ -81,16 +124,55 @@ def plot_components(graph, shp, key = "GEOID10"):
 #
 # adapted from GerryChain docs: https://gerrychain.readthedocs.io/en/latest/
 def find_node_by_key(keyval, graph, key = "GEOID10",):
-    for node in graph:
-        if graph.nodes[node][key] == keyval:
-            return node
-    return -1
+    node = _get_key_index(graph, key = key).get(keyval, -1)
+    # a miss or a stale hit means the graph changed since the index was built
+    if node == -1 or node not in graph or graph.nodes[node].get(key) != keyval:
+        node = _get_key_index(graph, key = key, rebuild = True).get(keyval, -1)
+    return node
+
 
+#######
+# _shp_rows()
+#  builds a dict of key value -> row position for a shapefile
+#  shared by the functions that resolve edge endpoints to shapefile rows
+#
+# shp: the shapefile to index
+# key: the primary key unique identifier of the shapefile
+#
+# returns
+#  dict of key value -> row position in shp, the last row wins if key values repeat
+def _shp_rows(shp, key = "GEOID10"):
+    return {k: i for i, k in enumerate(shp[key].to_numpy())}
+
+#######
+# _edge_rows()
+#  finds the shapefile row of both end points of each edge in a graph
+#  each node's key is looked up once, edges are then gathered as integer positions
+#
+# graph: the graph to pull edges from
+# shp:   the associated shapefile, with the geometries
+# key:   the primary key unique identifier of the shapefile
+#
+# returns
+#  int array of shape (E, 2), [i, 0] is the shp row of edge i's u endpoint, [i, 1] of its v endpoint,
+#  aligned with the order of graph.edges
+def _edge_rows(graph, shp, key = "GEOID10"):
+    row_of_key = _shp_rows(shp, key = key)
+    node_ids = list(graph.nodes)
+    # -1 marks nodes missing from shp, only an error if an edge actually touches one
+    node_row = np.fromiter((row_of_key.get(graph.nodes[n].get(key), -1) for n in node_ids), dtype = np.intp, count = len(node_ids))
+    node_pos = {n: i for i, n in enumerate(node_ids)}
+    n_edges = graph.number_of_edges()
+    edges_np = np.fromiter((node_pos[n] for e in graph.edges for n in e), dtype = np.intp, count = 2 * n_edges).reshape(n_edges, 2)
+    rows = node_row[edges_np]
+    missing = rows < 0
+    if missing.any():
+        raise KeyError(graph.nodes[node_ids[edges_np[missing][0]]].get(key))
+    return rows
 
 #######
 # edges_geoms()
 #  retrieves the geometries of the end points of each edge in a graph
-#  likely only ever to be called by the two functions below
 # 
 # graph: the graph to pull edges from
 # shp:   the associated shapefile, with the geometries
@@ -99,14 +181,29 @@ def find_node_by_key(keyval, graph, key = "GEOID10",):
 # returns
 #  list of (u,v) pairs, where u and v are the geometries of each respective edge's endpoints
 def edges_geoms(graph, shp, key = "GEOID10"):
-    key_dict = {}
-    for _idx, row in shp.iterrows():
-        key_dict[row[key]] = row['geometry']
-    edges = list(graph.edges)
-    nodes = [((graph.nodes[u]), (graph.nodes[v])) for u,v in edges]
-    keys = [(n1[key], n2[key]) for n1, n2 in nodes]
-    geoms = [(key_dict[k1], key_dict[k2]) for k1,k2 in keys]
-    return geoms
+    rows = _edge_rows(graph, shp, key = key)
+    geoms = shp['geometry'].to_numpy()
+    return list(zip(geoms[rows[:, 0]], geoms[rows[:, 1]]))
+
+#######
+# _edge_endpoint_coords()
+#  retrieves the centroid coordinates of the end points of each edge in a graph,
+#  without building the endpoint geometries themselves
+#  centroids are computed once per shape, not once per edge
+#
+# graph: the graph to pull edges from
+# shp:   the associated shapefile, with the geometries
+# key:   the primary key unique identifier of the shapefile
+# rows:  optional result of _edge_rows() for the same arguments, computed if None
+#
+# returns
+#  float array of shape (E, 2, 2), [i, 0] is the (x, y) of edge i's u centroid, [i, 1] of its v centroid
+def _edge_endpoint_coords(graph, shp, key = "GEOID10", rows = None):
+    if rows is None:
+        rows = _edge_rows(graph, shp, key = key)
+    centroids = shapely.centroid(shp['geometry'].to_numpy())
+    xy = np.column_stack([shapely.get_x(centroids), shapely.get_y(centroids)])
+    return xy[rows]
 
 #######
 # edges_to_gdf
@@ -119,8 +216,8 @@ def edges_geoms(graph, shp, key = "GEOID10"):
 # returns
 #  a GeoDataFrame of edges as LineStrings, projected to the crs of `shp`
 def edges_to_gdf(graph, shp, key = "GEOID10"):
-    dual = gpd.GeoDataFrame(gpd.GeoSeries([LineString([poly1.centroid, poly2.centroid]) for poly1,poly2 in edges_geoms(graph, shp, key = key)]), columns = ['geometry'])
-    return dual.set_crs(shp.crs)
+    lines = shapely.linestrings(_edge_endpoint_coords(graph, shp, key = key))
+    return gpd.GeoDataFrame(geometry = gpd.GeoSeries(lines, crs = shp.crs))
     
 #######
 # edges_to_shapefile()
@@ -131,13 +228,13 @@ def edges_to_gdf(graph, shp, key = "GEOID10"):
 # shp:     associated shapefile with geometries, resulting file will have this shapefiles projection
 # key:     primary key unique identifier of shapefile
 # outfile: file path to print shapefile
+# driver:  OGR driver to write with, e.g. "GPKG" or "FlatGeobuf", inferred from `outfile` if None
 #
 # returns
 #  nothing
-def edges_to_shapefile(graph, shp, key = "GEOID10", outfile = "outfile.shp"):
-    dual = gpd.GeoDataFrame(gpd.GeoSeries([LineString([poly1.centroid, poly2.centroid]) for poly1,poly2 in edges_geoms(graph, shp, key = key)]), columns = ['geometry'])
-    dual = dual.set_crs(shp.crs)
-    dual.to_file(outfile)
+def edges_to_shapefile(graph, shp, key = "GEOID10", outfile = "outfile.shp", driver = None):
+    dual = edges_to_gdf(graph, shp, key = key)
+    dual.to_file(outfile, driver = driver, engine = _WRITE_ENGINE)
 
 ##########
 # edges_geoms_endpoints, edges_to_gdf_endpoints, edges_to_shapefile_endpoints
@@ -149,36 +246,30 @@ def edges_to_shapefile(graph, shp, key = "GEOID10", outfile = "outfile.shp"):
 #  for a node. The endpoints are stored in columns `endpoint_u` and `endpoint_v`.
 #  Ordering between u and v is set by the networkx graph object.
 def edges_geoms_endpoints(graph, shp, endpoints = "GEOID10", key = "GEOID10"):
-    key_dict = {}
-    endpoint_dict = {}
-    for _idx, row in shp.iterrows():
-        key_dict[row[key]] = row['geometry']
-        endpoint_dict[row[key]] = row[endpoints]
-    edges = list(graph.edges)
-    nodes = [((graph.nodes[u]), (graph.nodes[v])) for u,v in edges]
-    keys = [(n1[key], n2[key]) for n1, n2 in nodes]
-    geoms = [(key_dict[k1], key_dict[k2]) for k1,k2 in keys]
-    endpoints = [(endpoint_dict[k1], endpoint_dict[k2]) for k1,k2 in keys]
+    rows = _edge_rows(graph, shp, key = key)
+    geoms = shp['geometry'].to_numpy()
+    ends = shp[endpoints].to_numpy()
+    geoms = list(zip(geoms[rows[:, 0]], geoms[rows[:, 1]]))
+    endpoints = list(zip(ends[rows[:, 0]], ends[rows[:, 1]]))
     return (geoms, endpoints)
 
 def edges_to_gdf_endpoints(graph, shp, endpoints = "GEOID10", key = "GEOID10"):
-    geos, endpoints = edges_geoms_endpoints(graph, shp, endpoints = endpoints, key = key)
-    ends_u, ends_v = zip(*endpoints)
-    dual = gpd.GeoDataFrame(zip(ends_u, ends_v, gpd.GeoSeries([LineString([poly1.centroid, poly2.centroid]) for poly1,poly2 in geos])), columns = ['endpoint_u','endpoint_v','geometry'])
-    return dual.set_crs(shp.crs)
+    rows = _edge_rows(graph, shp, key = key)
+    ends = shp[endpoints].to_numpy()
+    lines = shapely.linestrings(_edge_endpoint_coords(graph, shp, key = key, rows = rows))
+    return gpd.GeoDataFrame({'endpoint_u': ends[rows[:, 0]],
+                             'endpoint_v': ends[rows[:, 1]],
+                             'geometry': gpd.GeoSeries(lines, crs = shp.crs)})
     
-def edges_to_shapefile_endpoints(graph, shp, endpoints = "GEOID10", key = "GEOID10", outfile = "outfile.shp"):
-    geos, endpoints = edges_geoms_endpoints(graph, shp, endpoints = endpoints, key = key)
-    ends_u, ends_v = zip(*endpoints)
-    dual = gpd.GeoDataFrame(zip(ends_u, ends_v, gpd.GeoSeries([LineString([poly1.centroid, poly2.centroid]) for poly1,poly2 in geos])), columns = ['endpoint_u','endpoint_v','geometry'])
-    dual = dual.set_crs(shp.crs)
-    dual.to_file(outfile)
+def edges_to_shapefile_endpoints(graph, shp, endpoints = "GEOID10", key = "GEOID10", outfile = "outfile.shp", driver = None):
+    dual = edges_to_gdf_endpoints(graph, shp, endpoints = endpoints, key = key)
+    dual.to_file(outfile, driver = driver, engine = _WRITE_ENGINE)
 
 ####################
 # shared_boundaries_gdf
 #   stores the boundaries crossed by the edges of a dual graph
 # 
-# graph: graph to pull edges from
+# graph: graph to pull edges from, endpoints are looked up in `shp` directly, kept for compatibility
 # g_shp: shapefile of the graph with endpoint columns - should have been created
 #         by `edges_to_gdf_endpoints`
 # shp:   associated shapefile with geometries
@@ -187,17 +278,27 @@ def edges_to_shapefile_endpoints(graph, shp, endpoints = "GEOID10", key = "GEOID
 # returns
 #  a GeoDataFrame of crossed boundaries as MultiLineStrings, projected to the crs of `shp`
 def shared_boundaries_gdf(graph, g_shp, shp, key = "GEOID10"):
-    key_dict = {}
-    for _idx, row in shp.iterrows():
-        key_dict[row[key]] = row['geometry']
-    es = zip(g_shp['endpoint_u'], g_shp['endpoint_v'])
-    nodes = [(find_node_by_key(u, graph, key = key), find_node_by_key(v, graph, key = key)) for u,v in es]
-    keys = [(graph.nodes[n1][key], graph.nodes[n2][key]) for n1, n2 in nodes]
-    geoms = [(key_dict[k1], key_dict[k2]) for k1,k2 in keys]
-    overlaps = gpd.GeoDataFrame(gpd.GeoSeries([p1.intersection(p2) for p1,p2 in geoms]), columns = ['geometry'])
-    overlaps = overlaps.set_crs(shp.crs)
-    overlaps['endpoint_u'] = g_shp['endpoint_u']
-    overlaps['endpoint_v'] = g_shp['endpoint_v']
+    row_of_key = _shp_rows(shp, key = key)
+    geoms = shp['geometry'].to_numpy()
+    n_edges = len(g_shp)
+    arr1 = geoms[np.fromiter((row_of_key[u] for u in g_shp['endpoint_u']), dtype = np.intp, count = n_edges)]
+    arr2 = geoms[np.fromiter((row_of_key[v] for v in g_shp['endpoint_v']), dtype = np.intp, count = n_edges)]
+    # only clip pairs that can't be resolved cheaply: envelopes that don't touch
+    # share nothing, and a polygon covered by its neighbor is the whole overlap
+    b1 = shapely.bounds(arr1)
+    b2 = shapely.bounds(arr2)
+    disjoint = ((b1[:, 0] > b2[:, 2]) | (b2[:, 0] > b1[:, 2]) |
+                (b1[:, 1] > b2[:, 3]) | (b2[:, 1] > b1[:, 3]))
+    covered = np.zeros(len(arr1), dtype = bool)
+    covered[~disjoint] = shapely.covers(arr1[~disjoint], arr2[~disjoint])
+    clip = ~(disjoint | covered)
+    overlaps_geom = np.empty(len(arr1), dtype = object)
+    overlaps_geom[disjoint] = shapely.Polygon()
+    overlaps_geom[covered] = arr2[covered]
+    overlaps_geom[clip] = shapely.intersection(arr1[clip], arr2[clip])
+    overlaps = gpd.GeoDataFrame({'geometry': overlaps_geom,
+                                 'endpoint_u': g_shp['endpoint_u'].to_numpy(),
+                                 'endpoint_v': g_shp['endpoint_v'].to_numpy()}, crs = shp.crs)
     return overlaps
 
 ########
@@ -208,21 +309,55 @@ def shared_boundaries_gdf(graph, g_shp, shp, key = "GEOID10"):
 # u_key: key value of one endpoint
 # v_key: key value of second endpoint
 # key:   the column/attribute to compare to the given values
+# index: optional prebuilt dict of key value -> node, pass one in to skip the per-call lookup
+#          build it with _get_key_index(graph, key) so that, like find_node_by_key,
+#          the first node in graph order wins if key values repeat
 #
 # returns
 #  graph with the edge added or removed
-def remove_edge_by_feature(graph, u_key, v_key, key):
-    u = find_node_by_key(u_key, graph, key = key)
-    v = find_node_by_key(v_key, graph, key = key)
+def remove_edge_by_feature(graph, u_key, v_key, key, index = None):
+    if index is None:
+        u = find_node_by_key(u_key, graph, key = key)
+        v = find_node_by_key(v_key, graph, key = key)
+    else:
+        u = index[u_key]
+        v = index[v_key]
     graph.remove_edge(u,v)
     return graph
 
-def add_edge_by_feature(graph, u_key, v_key, key):
-    u = find_node_by_key(u_key, graph, key = key)
-    v = find_node_by_key(v_key, graph, key = key)
+def add_edge_by_feature(graph, u_key, v_key, key, index = None):
+    if index is None:
+        u = find_node_by_key(u_key, graph, key = key)
+        v = find_node_by_key(v_key, graph, key = key)
+    else:
+        u = index[u_key]
+        v = index[v_key]
     graph.add_edge(u,v)
     return graph
 
+########
+# [remove/add]_edges_by_feature()
+#  either removes or adds many edges between nodes that have certain values in a column
+#  the key -> node index is built once for the whole batch, and the graph is edited in one call
+#
+# graph: the graph to edit
+# pairs: iterable of (u_key, v_key) tuples, key values of each edge's endpoints
+# key:   the column/attribute to compare to the given values
+#
+# returns
+#  graph with the edges added or removed
+#  if any key value in `pairs` matches no node, raises KeyError naming that value
+#   and leaves the graph unchanged, unlike the single edge functions, which fall back to node -1
+def remove_edges_by_feature(graph, pairs, key):
+    idx = _get_key_index(graph, key = key, rebuild = True)
+    graph.remove_edges_from([(idx[u], idx[v]) for u,v in pairs])
+    return graph
+
+def add_edges_by_feature(graph, pairs, key):
+    idx = _get_key_index(graph, key = key, rebuild = True)
+    graph.add_edges_from([(idx[u], idx[v]) for u,v in pairs])
+    return graph
+
 ########
 # mark_edges
 #  sets a column value in a from-graph GeoDataFrame for a list of edges
@@ -241,14 +376,7 @@ def add_edge_by_feature(graph, u_key, v_key, key):
 # returns
 #  a GeoDataFrame with edges from `marks` marked with `val` in the column `col`
 def mark_edges(g_shp, marks, col = "marked", val = 1):
-    if col not in list(g_shp):
-        g_shp[col] = 0
-    for u,v in marks:
-        # try u,v
-        g_shp.loc[(g_shp['endpoint_u'] == u) & (g_shp['endpoint_v'] == v), col] = val
-        # try v,u
-        g_shp.loc[(g_shp['endpoint_v'] == u) & (g_shp['endpoint_u'] == u), col] = val
-    return g_shp
+    return mark_edges_dict(g_shp, {(u,v): val for u,v in marks}, col = col)
 
 ########
 # mark_edges_dict
@@ -266,13 +394,29 @@ def mark_edges(g_shp, marks, col = "marked", val = 1):
 #  a GeoDataFrame with edges from `marks` marked with the corresponding value from `marks`
 #  in the column `col`
 def mark_edges_dict(g_shp, marks, col = "marked"):
-    if col not in list(g_shp):
+    if col not in g_shp.columns:
         g_shp[col] = 0
-    for k,val in marks.items():
-        u = k[0]
-        v = k[1]
-        # try u,v
-        g_shp.loc[(g_shp['endpoint_u'] == u) & (g_shp['endpoint_v'] == v), col] = val
-        # try v,u
-        g_shp.loc[(g_shp['endpoint_v'] == u) & (g_shp['endpoint_u'] == u), col] = val
+    # store every edge and mark as an unordered frozenset so (u,v) and (v,u) match in one lookup
+    mark_map = {frozenset((u,v)): val for (u,v),val in marks.items()}
+    canon = pd.Series([frozenset(e) for e in zip(g_shp['endpoint_u'], g_shp['endpoint_v'])], index = g_shp.index)
+    # hits are decided by key membership, so NaN or None marks still get set
+    hit = np.fromiter((e in mark_map for e in canon), dtype = bool, count = len(canon))
+    if hit.any():
+        vals = [mark_map[e] for e in canon[hit]]
+        dtype = g_shp[col].dtype
+        if all(v is vals[0] for v in vals):
+            # a single value, e.g. from mark_edges, is written as a scalar like a plain .loc assignment
+            g_shp.loc[hit, col] = vals[0]
+        else:
+            idx = g_shp.index[hit]
+            try:
+                # build numeric values in the column's own dtype, so e.g. int8 and Int64 columns keep it
+                if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_float_dtype(dtype):
+                    new_vals = pd.Series(vals, index = idx, dtype = dtype)
+                else:
+                    new_vals = pd.Series(vals, index = idx)
+            except (TypeError, ValueError, OverflowError):
+                # values don't fit, e.g. None in an int column, let .loc upcast the column
+                new_vals = pd.Series(vals, index = idx)
+            g_shp.loc[hit, col] = new_vals
     return g_shp
\ No newline at end of file